@@ -1,10 +1,34 @@
 import streamlit as st
 import time
-from langchain.chat_models import ChatOpenAI
-from langchain.schema import HumanMessage
+import asyncio
+import threading
+import hashlib
+import glob
+import uuid
+import tempfile
+import contextlib
+import re
+import html
+import functools
 import json
+import os
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib encoder
+    orjson = None
+try:
+    import fcntl
+except ImportError:  # Windows has no fcntl; msvcrt provides the equivalent lock
+    fcntl = None
+    import msvcrt
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+from llm_cache import cache_key, check_cache, save_to_cache, embed_prompt_async, semantic_lookup, semantic_store
+
+if TYPE_CHECKING:
+    import httpx
+    from aiolimiter import AsyncLimiter
+    from langchain.chat_models import ChatOpenAI
 
 # Page config for better appearance
 st.set_page_config(
@@ -15,13 +39,48 @@ st.set_page_config(
 )
 
 # Constants
-CHAT_HISTORY_FILE = "chat_history.json"
+CHAT_HISTORY_FILE = "chat_history-{user}.jsonl"  # one file per API key
+PARTIAL_MESSAGE_SUFFIX = ".partial"
 MODEL_NAME = "sonar-deep-research"
 API_BASE_URL = "https://api.perplexity.ai"
+MAX_TOKENS = 2000
+DEFAULT_TEMPERATURE = 0.7
+STREAM_FLUSH_INTERVAL = 0.05  # seconds between UI updates while streaming
+CHECKPOINT_INTERVAL = 1.0  # seconds between saves of an in-progress response
+REQUESTS_PER_MINUTE = 50  # API calls allowed per minute across all sessions
+
+# Conversation window sent to the model: the first HISTORY_HEAD_MESSAGES and
+# last HISTORY_TAIL_MESSAGES prior messages are kept verbatim.
+HISTORY_HEAD_MESSAGES = 2
+HISTORY_TAIL_MESSAGES = 6
+HISTORY_TOKEN_BUDGET = 6000
+
+# Only the most recent messages are rendered; older ones load in pages on request
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_VISIBLE = 500
+
+# The system prompt and the head of the conversation form the request prefix that
+# the provider can cache between turns. Keep SYSTEM_PROMPT a constant literal (no
+# timestamps or ids) and never reorder or rewrite earlier messages, otherwise every
+# request misses the prefix cache and pays full prefill again.
+SYSTEM_PROMPT = (
+    "You are a research assistant. Answer thoroughly, cite your sources, "
+    "and format responses in Markdown."
+)
+
+# Sonar Deep Research prefixes its answer with a <think>...</think> reasoning block
+_THINK_RE = re.compile(r"<think>(.*?)</think>\s*(.*)", re.DOTALL)
+
+# Status shown in the assistant message until the first chunk arrives
+_THINKING_TPL = (
+    '<div class="thinking-box">'
+    '<span class="searching-text">Searching</span><br>'
+    '<span>{prompt}</span>'
+    '</div>'
+)
 
 # Custom CSS for better UI
-def apply_custom_css():
-    st.markdown("""
+CUSTOM_CSS = """
         <style>
         .main .block-container {padding-top: 2rem;}
         .stChatMessage {
@@ -30,17 +89,13 @@ def apply_custom_css():
             padding: 0.5rem;
             margin-bottom: 1rem;
         }
-        .user-message {
+        [data-testid="stChatMessage"]:has([data-testid="stChatMessageAvatarUser"]) {
             background-color: #2D3748;
             color: white;
-            padding: 1rem;
-            border-radius: 8px;
         }
-        .assistant-message {
+        [data-testid="stChatMessage"]:has([data-testid="stChatMessageAvatarAssistant"]) {
             background-color: #1E1E1E;
             color: #F0F0F0;
-            padding: 1rem;
-            border-radius: 8px;
         }
         .thinking-box {
             background-color: #1A1A1A;
@@ -53,83 +108,549 @@ def apply_custom_css():
             color: #4DA6FF;
             font-weight: bold;
         }
-        .meta-info {
-            font-size: 0.8rem;
-            color: #888;
-            text-align: right;
-        }
         .sidebar .block-container {
             background-color: #1A1A1A;
         }
         </style>
-    """, unsafe_allow_html=True)
+    """
+
+@st.cache_data(show_spinner=False)
+def _css() -> str:
+    """Return the custom CSS payload."""
+    return CUSTOM_CSS
+
+def apply_custom_css():
+    # Streamlit drops elements that are not re-emitted on a rerun, so the style
+    # block is written on every run; only the payload itself is cached.
+    st.markdown(_css(), unsafe_allow_html=True)
+
+# Function to import LangChain on first use
+@st.cache_resource(show_spinner=False)
+def _lc():
+    """Import LangChain lazily so the page renders before the heavy import runs."""
+    from langchain.chat_models import ChatOpenAI
+    from langchain.schema import HumanMessage, SystemMessage, AIMessage
+    return ChatOpenAI, HumanMessage, SystemMessage, AIMessage
+
+# Function to get the process-wide HTTP connection pools
+@st.cache_resource(show_spinner=False)
+def get_http_clients() -> Tuple["httpx.Client", "httpx.AsyncClient"]:
+    """Create the sync and async httpx clients shared by every chat model in the process."""
+    import httpx
+
+    http_options = dict(
+        http2=True,
+        headers={"Accept-Encoding": "br, gzip"},
+        timeout=httpx.Timeout(120.0, connect=10.0),
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0)
+    )
+    return httpx.Client(**http_options), httpx.AsyncClient(**http_options)
 
 # Function to initialize the chat model
-def initialize_chat_model(api_key: str) -> ChatOpenAI:
-    """Initialize the ChatOpenAI model with the provided API key."""
+@st.cache_resource(show_spinner=False, max_entries=4)
+def initialize_chat_model(api_key: str, model: str = MODEL_NAME, temperature: float = DEFAULT_TEMPERATURE) -> "ChatOpenAI":
+    """Initialize the ChatOpenAI model once per (api_key, model, temperature) so its connection pool is reused."""
+    import openai
+
+    # ChatOpenAI would hand one http_client to both the sync and async OpenAI
+    # clients, so build each with its matching pooled httpx client instead
+    http_client, async_http_client = get_http_clients()
+    client = openai.OpenAI(api_key=api_key, base_url=API_BASE_URL, http_client=http_client)
+    async_client = openai.AsyncOpenAI(api_key=api_key, base_url=API_BASE_URL, http_client=async_http_client)
+
+    ChatOpenAI = _lc()[0]
     return ChatOpenAI(
         openai_api_key=api_key,
         openai_api_base=API_BASE_URL,
-        model=MODEL_NAME,
-        max_tokens=2000
+        model=model,
+        temperature=temperature,
+        max_tokens=MAX_TOKENS,
+        streaming=True,
+        client=client.chat.completions,
+        async_client=async_client.chat.completions
     )
 
+# Function to get the shared background event loop
+@st.cache_resource(show_spinner=False)
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Start an event loop on a daemon thread that runs all async model calls."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="llm-event-loop", daemon=True).start()
+    return loop
+
+# Function to get the shared API rate limiter
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter() -> "AsyncLimiter":
+    """Return the token bucket that every API call waits on, so bursts queue instead of hitting 429s."""
+    from aiolimiter import AsyncLimiter
+    return AsyncLimiter(REQUESTS_PER_MINUTE, 60)
+
+# Function to get the checkpoint files of responses still streaming
+@st.cache_resource(show_spinner=False)
+def get_live_partials() -> set:
+    """Return the checkpoint files owned by running responses, shared by all sessions."""
+    return set()
+
+# Function to start a response on the background event loop
+def start_response(chat_model: "ChatOpenAI", messages: List, filename: str) -> Dict:
+    """Start chat_model.astream() on the shared event loop and return the state it fills in.
+
+    The request belongs to the event loop rather than the script run, so it keeps
+    going when a widget interaction reruns the script or the browser reloads. It
+    checkpoints the message as it streams and appends the finished message to the
+    chat history file itself.
+    """
+    partial_file = partial_message_file(filename, uuid.uuid4().hex)
+    response = {"parts": [], "done": False, "cancelled": False, "error": None, "save_error": None,
+                "first_chunk": None, "finished": None, "message": None, "partial_file": partial_file}
+    limiter = get_rate_limiter()
+    live_partials = get_live_partials()
+    start_time = time.monotonic()
+
+    # Persist the empty shell before the request, so a reload at any point still
+    # finds a reply after the user message
+    live_partials.add(partial_file)
+    _atomic_write(partial_file, _dumps_line({"role": "assistant", "content": ""}), durable=False)
+
+    async def produce():
+        last_save = time.monotonic()
+        try:
+            async with limiter:
+                async for chunk in chat_model.astream(messages):
+                    now = time.monotonic()
+                    if response["first_chunk"] is None:
+                        response["first_chunk"] = now
+                    response["parts"].append(chunk.content)
+                    if now - last_save >= CHECKPOINT_INTERVAL and not response["cancelled"]:
+                        message = {"role": "assistant", "content": "".join(response["parts"])}
+                        # File I/O runs in a worker thread so it can't stall other sessions' streams
+                        await asyncio.to_thread(_atomic_write, partial_file, _dumps_line(message), durable=False)
+                        last_save = now
+        except asyncio.CancelledError:
+            response["cancelled"] = True
+            raise
+        except Exception as e:
+            response["error"] = e
+        finally:
+            response["finished"] = time.monotonic()
+            try:
+                if not response["cancelled"]:
+                    if response["error"] is None:
+                        response_data = {
+                            "content": "".join(response["parts"]),
+                            "time_taken": round(response["finished"] - start_time, 2)
+                        }
+                        if response["first_chunk"] is not None:
+                            response_data["time_to_first_token"] = round(response["first_chunk"] - start_time, 2)
+                    else:
+                        response_data = {"content": f"I encountered an error: {str(response['error'])}", "time_taken": 0}
+                    response["message"] = assistant_record(response_data)
+                    await asyncio.to_thread(_append_line, filename, _dumps_line(response["message"]))
+            except Exception as e:
+                response["save_error"] = e
+            finally:
+                try:
+                    await asyncio.to_thread(clear_partial_message, partial_file)
+                finally:
+                    live_partials.discard(partial_file)
+                    response["done"] = True
+
+    response["future"] = asyncio.run_coroutine_threadsafe(produce(), get_event_loop())
+    return response
+
+# Function to serialize a chat history record
+def _dumps_line(message: Dict) -> bytes:
+    """Serialize a message as one JSON Lines record."""
+    if orjson is not None:
+        return orjson.dumps(message, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS)
+    return (json.dumps(message) + "\n").encode("utf-8")
+
+# Function to lock a chat history file
+@contextlib.contextmanager
+def _file_lock(filename: str):
+    """Hold an exclusive lock on the file's .lock sibling, shared with other sessions and processes."""
+    with open(f"{filename}.lock", "a+b") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            # Retries for about 10 seconds before raising
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+# Function to replace a file atomically
+def _atomic_write(filename: str, data: bytes, durable: bool = True):
+    """Write to a unique sibling file and rename it over the target so readers never see a torn file."""
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or ".", prefix=os.path.basename(filename) + ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_filename)
+        raise
+
+# Function to append a record to a chat history file
+def _append_line(filename: str, data: bytes):
+    """Append one record under the file lock, so it can't land in a file being replaced."""
+    with _file_lock(filename), open(filename, "ab") as f:
+        f.write(data)
+
+# Function to name the chat history file of an API key
+def chat_history_file(api_key: str) -> str:
+    """Return the history file for the API key, so each user only ever loads their own chats."""
+    return CHAT_HISTORY_FILE.format(user=hashlib.sha256(api_key.encode()).hexdigest()[:16])
+
+# Function to name the checkpoint file of a response
+def partial_message_file(filename: str, response_id: str) -> str:
+    """Return the file holding a response's in-progress assistant message, next to its chat history."""
+    return f"{filename}.{response_id}{PARTIAL_MESSAGE_SUFFIX}"
+
+# Function to build the chat history record of an assistant response
+def assistant_record(response_data: Dict) -> Dict:
+    """Return the assistant message for a response, with its timing metadata."""
+    metadata = {
+        "time_taken": response_data["time_taken"],
+        "timestamp": time.time_ns(),
+        "model": MODEL_NAME
+    }
+    if "time_to_first_token" in response_data:
+        metadata["time_to_first_token"] = response_data["time_to_first_token"]
+    return {"role": "assistant", "content": response_data["content"], "metadata": metadata}
+
 # Function to save chat history
-def save_chat_history(messages: List[Dict], filename: str = CHAT_HISTORY_FILE) -> str:
-    """Save chat history to a JSON file."""
+def save_chat_history(messages: List[Dict], filename: str) -> str:
+    """Save chat history to a JSON Lines file, replacing it atomically."""
     try:
-        with open(filename, "w") as f:
-            json.dump(messages, f, indent=4)
+        with _file_lock(filename):
+            _atomic_write(filename, b"".join(_dumps_line(message) for message in messages))
         return filename
     except Exception as e:
         st.error(f"Failed to save chat history: {str(e)}")
         return ""
 
+# Function to append a message to the chat history
+def append_message(message: Dict, filename: str) -> str:
+    """Append a single message to the JSON Lines chat history file."""
+    try:
+        _append_line(filename, _dumps_line(message))
+        return filename
+    except Exception as e:
+        st.error(f"Failed to save chat history: {str(e)}")
+        return ""
+
+# Function to parse the chat history file
+@st.cache_data(show_spinner=False, max_entries=2)
+def _load_chat_history_cached(filename: str, mtime_ns: int, size: int) -> List[Dict]:
+    """Parse the JSON Lines chat history; cached until the file's mtime or size changes."""
+    loads = orjson.loads if orjson is not None else json.loads
+    with open(filename, "rb") as f:
+        return [loads(line) for line in f if line.strip()]
+
+# Function to read a chat history file
+def _load_chat_history_file(filename: str) -> List[Dict]:
+    """Return the parsed file, keyed on mtime and size so two writes within one mtime tick aren't missed."""
+    stat = os.stat(filename)
+    return _load_chat_history_cached(filename, stat.st_mtime_ns, stat.st_size)
+
+# Function to read a checkpointed assistant message
+def load_partial_message(filename: str) -> Optional[Dict]:
+    """Return the checkpointed assistant message, or None if the file is gone."""
+    # Checkpoints change every second, so they are read directly rather than cached
+    loads = orjson.loads if orjson is not None else json.loads
+    try:
+        with open(filename, "rb") as f:
+            return loads(f.read())
+    except FileNotFoundError:
+        return None
+
+# Function to remove a checkpointed assistant message
+def clear_partial_message(filename: str):
+    """Delete the checkpoint once the response is in the chat history."""
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+# Function to move interrupted responses into the chat history
+def flush_partial_messages(filename: str):
+    """Append the responses a stopped server left unfinished, so every user message keeps its reply."""
+    live_partials = get_live_partials()
+    for partial_file in sorted(glob.glob(f"{glob.escape(filename)}.*{PARTIAL_MESSAGE_SUFFIX}")):
+        if partial_file in live_partials:
+            continue
+        # Claim the checkpoint first so two sessions loading at once don't both append it
+        claimed_file = f"{partial_file}.flushing"
+        try:
+            os.rename(partial_file, claimed_file)
+        except FileNotFoundError:
+            continue
+        message = load_partial_message(claimed_file)
+        if message is not None:
+            append_message(message, filename)
+        clear_partial_message(claimed_file)
+
 # Function to load chat history
-def load_chat_history(filename: str = CHAT_HISTORY_FILE) -> List[Dict]:
-    """Load chat history from a JSON file."""
+def load_chat_history(filename: str) -> List[Dict]:
+    """Load chat history from a JSON Lines file."""
     try:
-        with open(filename, "r") as f:
-            return json.load(f)
+        flush_partial_messages(filename)
+        return _load_chat_history_file(filename)
     except FileNotFoundError:
         return []
     except Exception as e:
         st.error(f"Failed to load chat history: {str(e)}")
         return []
 
+# Function to read the responses still streaming into a chat history file
+def load_live_messages(filename: str) -> Dict[str, Dict]:
+    """Return the checkpointed assistant messages of running responses, keyed by checkpoint file."""
+    live = {}
+    for partial_file in sorted(glob.glob(f"{glob.escape(filename)}.*{PARTIAL_MESSAGE_SUFFIX}")):
+        message = load_partial_message(partial_file)
+        if message is not None:
+            live[partial_file] = message
+    return live
+
+# Function to split the reasoning block from the answer
+@functools.lru_cache(maxsize=512)
+def split_think(content: str) -> Tuple[Optional[str], str]:
+    """Return the (thinking, answer) parts of a response; thinking is None if absent."""
+    match = _THINK_RE.match(content)
+    return (match.group(1), match.group(2)) if match else (None, content)
+
+# Function to load the tokenizer used for the history budget
+@st.cache_resource(show_spinner=False)
+def get_token_encoding():
+    """Load the tiktoken encoding used to count message tokens."""
+    import tiktoken
+    return tiktoken.get_encoding("cl100k_base")
+
+# Function to count the tokens in a message
+@functools.lru_cache(maxsize=1024)
+def count_tokens(text: str) -> int:
+    """Return the token count of the text, memoized so history isn't re-encoded every turn."""
+    return len(get_token_encoding().encode(text))
+
+# Function to fit the outgoing messages into the token budget
+def trim_messages(messages: List, max_tokens: int = HISTORY_TOKEN_BUDGET) -> List:
+    """Drop the oldest turns after the cached head until the messages fit the token budget."""
+    counts = [count_tokens(message.content) for message in messages]
+    total = sum(counts)
+
+    # The system prompt, the head turns and the new prompt are always kept; turns are
+    # dropped as (user, assistant) pairs because the API rejects non-alternating roles
+    drop_index = 1 + HISTORY_HEAD_MESSAGES
+    messages = list(messages)
+    while total > max_tokens and len(messages) > drop_index + 2:
+        total -= counts.pop(drop_index) + counts.pop(drop_index)
+        del messages[drop_index:drop_index + 2]
+    return messages
+
+# Function to get the shared system message
+@st.cache_resource(show_spinner=False)
+def _system_message():
+    """Build the SystemMessage once per process; it is never mutated."""
+    SystemMessage = _lc()[2]
+    return SystemMessage(content=SYSTEM_PROMPT)
+
+# Function to build the messages sent to the model
+def build_messages(prompt: str, history: List[Dict]) -> List:
+    """Build a prefix-stable message list from the system prompt, prior turns and the new prompt."""
+    # Drop messages only from the middle so the cached prefix stays byte-identical
+    if len(history) > HISTORY_HEAD_MESSAGES + HISTORY_TAIL_MESSAGES:
+        history = history[:HISTORY_HEAD_MESSAGES] + history[-HISTORY_TAIL_MESSAGES:]
+
+    _, HumanMessage, _, AIMessage = _lc()
+    messages = [
+        _system_message(),
+        *(
+            HumanMessage(content=message["content"]) if message["role"] == "user"
+            else AIMessage(content=split_think(message["content"])[1])
+            for message in history
+        ),
+        HumanMessage(content=prompt),
+    ]
+    return trim_messages(messages)
+
+# Function to follow a background response
+def follow_response(response: Dict, interval: float = STREAM_FLUSH_INTERVAL) -> Iterator[str]:
+    """Yield the text a background response produces, batched to at most one update per interval.
+
+    Following always starts from the first chunk, so a rerun can reattach to a
+    response that is still streaming.
+    """
+    index = 0
+    while True:
+        # Read the flag first: once it is set, every chunk is already in parts
+        done = response["done"]
+        end = len(response["parts"])
+        if index < end:
+            yield "".join(response["parts"][index:end])
+            index = end
+        if done:
+            break
+        time.sleep(interval)
+    if response["error"] is not None:
+        raise response["error"]
+
+# Function to save a response answered on the script thread
+def persist_response(response_data: Dict) -> Dict:
+    """Append the assistant record of a cached or failed response to the chat history and return it."""
+    record = assistant_record(response_data)
+    append_message(record, st.session_state.history_file)
+    return record
+
 # Function to handle chat
-def process_chat(prompt: str, chat_model: ChatOpenAI) -> Dict:
-    """Process the user's prompt and return the assistant's response."""
+def process_chat(prompt: str, chat_model: "ChatOpenAI", response_container, history: List[Dict],
+                 assistant_message: Dict) -> Dict:
+    """Answer the user's prompt, streaming into the container; returns the assistant record, already saved."""
     try:
-        messages = [HumanMessage(content=prompt)]
-
-        # Get response from Perplexity
-        with st.spinner(""):
-            start_time = time.time()
-            response = chat_model(messages)
-            end_time = time.time()
-
-        return {
-            "content": response.content,
-            "time_taken": round(end_time - start_time, 2)
+        # The semantic cache only matches opening prompts, since a follow-up such as
+        # "Tell me more" means something different in every conversation
+        use_cache = not st.session_state.get("bypass_cache", False)
+        use_semantic = use_cache and not history
+
+        # Embed the prompt in the background while the messages are built and the exact-match cache is checked
+        embedding = embed_prompt_async(prompt) if use_semantic else None
+        messages = build_messages(prompt, history)
+
+        # Serve identical requests from the cache without calling the API
+        key = cache_key(MODEL_NAME, messages, MAX_TOKENS)
+        cached = check_cache(key) if use_cache else None
+        if cached is not None:
+            return persist_response({"content": cached, "time_taken": 0})
+
+        # Fall back to a semantically similar earlier prompt; the semantic cache is
+        # optional, so the turn goes ahead without it if the embedding model fails
+        prompt_vector = None
+        if embedding is not None:
+            try:
+                prompt_vector = embedding.result()
+            except Exception:
+                prompt_vector = None
+        cached = semantic_lookup(prompt_vector) if prompt_vector is not None else None
+        if cached is not None:
+            return persist_response({"content": cached, "time_taken": 0})
+
+        # Stream the response from Perplexity; the request runs in the background and
+        # is tracked in session state so a rerun reattaches to it
+        st.session_state._pending = {
+            "response": start_response(chat_model, messages, st.session_state.history_file),
+            "message": assistant_message,
+            "key": key,
+            "vector": prompt_vector
         }
+        return follow_pending_response(response_container)
     except Exception as e:
         st.error(f"Error processing chat: {str(e)}")
-        return {"content": f"I encountered an error: {str(e)}", "time_taken": 0}
+        return persist_response({"content": f"I encountered an error: {str(e)}", "time_taken": 0})
+
+# Function to stream the pending response
+def follow_pending_response(response_container) -> Dict:
+    """Stream the background response into the container and return its record once the task has saved it."""
+    pending = st.session_state._pending
+    response = pending["response"]
+    interval = st.session_state.get("stream_flush_ms", STREAM_FLUSH_INTERVAL * 1000) / 1000
+    try:
+        full_response = response_container.write_stream(follow_response(response, interval))
+    except Exception as e:
+        del st.session_state._pending
+        st.error(f"Error processing chat: {str(e)}")
+        return response["message"] or assistant_record({"content": f"I encountered an error: {str(e)}", "time_taken": 0})
+    del st.session_state._pending
+
+    if response["save_error"] is not None:
+        st.error(f"Failed to save chat history: {str(response['save_error'])}")
+
+    # An empty answer would otherwise be replayed from the cache for every repeat of the prompt
+    if full_response:
+        save_to_cache(pending["key"], full_response)
+        if pending["vector"] is not None:
+            semantic_store(pending["vector"], full_response)
+    return response["message"]
+
+# Function to describe response timings
+def response_meta(data: Dict) -> str:
+    """Return the timing line shown under an assistant response."""
+    text = f"Response time: {data['time_taken']}s"
+    if "time_to_first_token" in data:
+        text += f" · First token: {data['time_to_first_token']}s"
+    return text
+
+# Function to display an assistant response
+def display_assistant_content(content: str):
+    """Display the answer, with any reasoning block collapsed in an expander."""
+    thinking, answer = split_think(content)
+    if thinking:
+        with st.expander("Thinking"):
+            st.markdown(thinking)
+    st.markdown(answer)
+
+# Function to reveal older messages
+def show_more_messages():
+    """Render another page of older messages on the next run."""
+    visible = st.session_state.get("visible_messages", HISTORY_PAGE_SIZE)
+    st.session_state.visible_messages = min(visible + HISTORY_PAGE_SIZE, HISTORY_MAX_VISIBLE)
 
 # Function to display chat history
 def display_chat_history(messages: List[Dict]):
-    """Display the chat history in the Streamlit app."""
+    """Display the most recent messages of the chat history in the Streamlit app."""
+    visible = st.session_state.get("visible_messages", HISTORY_PAGE_SIZE)
+    hidden = len(messages) - visible
+    if hidden > 0:
+        # Past HISTORY_MAX_VISIBLE there is nothing more to load, so don't offer it
+        if visible < HISTORY_MAX_VISIBLE:
+            st.button(f"Load {min(HISTORY_PAGE_SIZE, hidden)} more", key="load_more_messages", on_click=show_more_messages)
+        messages = messages[-visible:]
+
     for message in messages:
         if message["role"] == "user":
             with st.chat_message("user", avatar="👤"):  # User avatar
-                st.markdown(f"<div class='user-message'>{message['content']}</div>", unsafe_allow_html=True)
+                st.markdown(message["content"])
         else:
             with st.chat_message("assistant", avatar="🤖"):  # Assistant avatar
-                st.markdown(f"<div class='assistant-message'>{message['content']}</div>", unsafe_allow_html=True)
+                display_assistant_content(message["content"])
                 if "metadata" in message:
-                    st.markdown(f"<div class='meta-info'>Response time: {message['metadata']['time_taken']}s</div>",
-                                unsafe_allow_html=True)
+                    st.caption(response_meta(message["metadata"]))
+
+# Function to display responses streaming in other sessions
+def display_live_messages(live: Dict[str, Dict]):
+    """Display checkpointed responses as placeholders; they are not part of the session's messages."""
+    for message in live.values():
+        with st.chat_message("assistant", avatar="🤖"):  # Assistant avatar
+            display_assistant_content(message["content"])
+            st.caption("Still generating...")
+
+# Function to stop the pending response
+def cancel_pending_response():
+    """Cancel the response still streaming for this session, if any, without saving it."""
+    pending = st.session_state.pop("_pending", None)
+    if pending:
+        response = pending["response"]
+        response["cancelled"] = True
+        response["future"].cancel()
+        # A task cancelled before it starts never runs its cleanup, so do it here too
+        clear_partial_message(response["partial_file"])
+        get_live_partials().discard(response["partial_file"])
+
+# Function to start a new chat
+def start_new_chat():
+    """Clear the chat history; used as a button callback so no extra rerun is needed."""
+    # Stop any response still streaming for the old chat
+    cancel_pending_response()
+    st.session_state.messages = []
+    save_chat_history([], st.session_state.history_file)
 
 # Function to handle the sidebar
 def sidebar_configuration() -> Optional[str]:
@@ -137,22 +658,127 @@ def sidebar_configuration() -> Optional[str]:
     st.sidebar.header(":gear: Configuration")
 
     # API Key handling
-    api_key = st.sidebar.text_input("Enter your Perplexity API Key", type="password")
-    if api_key:
+    api_key = (st.sidebar.text_input("Enter your Perplexity API Key", type="password") or "").strip()
+    if api_key and api_key != st.session_state.get("api_key"):
         st.session_state.api_key = api_key
         st.sidebar.success("API Key saved!")
 
+    # Display settings are batched in a form so adjusting them costs a single rerun
+    with st.sidebar.form("settings", border=False):
+        # Streaming refresh rate; slower clients can pick a longer interval
+        st.slider(
+            "Streaming refresh interval (ms)",
+            min_value=16,
+            max_value=200,
+            value=int(STREAM_FLUSH_INTERVAL * 1000),
+            key="stream_flush_ms"
+        )
+
+        # Number of history messages rendered on each run; "Load more" also updates it
+        st.session_state.setdefault("visible_messages", HISTORY_PAGE_SIZE)
+        st.slider(
+            "Messages shown",
+            min_value=HISTORY_PAGE_SIZE,
+            max_value=HISTORY_MAX_VISIBLE,
+            step=HISTORY_PAGE_SIZE,
+            key="visible_messages"
+        )
+
+        # Skip cached answers when fresh results are wanted; new answers are still cached by exact match
+        st.checkbox("Bypass cache", key="bypass_cache")
+
+        st.form_submit_button("Apply settings")
+
     # New buttons
     st.sidebar.subheader("Actions")
-    if st.sidebar.button("Start New Chat", key="start_new_chat"):
-        st.session_state.messages = []  # Clear chat history
-        st.rerun()
+    st.sidebar.button("Start New Chat", key="start_new_chat", on_click=start_new_chat)
 
     st.sidebar.markdown("---")  # Divider
     st.sidebar.write(":heart: Built by [Build Fast with AI](https://buildfastwithai.com/genai-course)")
 
     return api_key if api_key else None
 
+# Function to finish an assistant response
+def finish_response(response_container, record: Dict, assistant_message: Dict):
+    """Display the final response with its timings and update the session's copy of the message."""
+    # Display the response
+    with response_container.container():
+        display_assistant_content(record["content"])
+
+    # Show metadata about the response
+    st.caption(response_meta(record["metadata"]))
+
+    # The record is already in the chat history file
+    assistant_message.update(record)
+
+# Function to render the chat area
+@st.fragment
+def chat_area(api_key: str):
+    """Render the chat history and input; reruns triggered here skip the rest of the page."""
+    pending = st.session_state.get("_pending")
+
+    # A response another session is streaming is appended to the file by its own
+    # task; reload the history once it has finished so the full answer shows up
+    history_file = st.session_state.history_file
+    live = load_live_messages(history_file)
+    if pending:
+        live.pop(pending["response"]["partial_file"], None)
+    else:
+        if any(partial_file not in live for partial_file in st.session_state.get("live_files", ())):
+            st.session_state.messages = load_chat_history(history_file)
+        st.session_state.live_files = list(live)
+
+    # Display chat history; a response still streaming is rendered live below
+    messages = st.session_state.messages
+    display_chat_history(messages[:-1] if pending else messages)
+    display_live_messages(live)
+
+    # Reattach to a response that an interrupted run left streaming
+    if pending:
+        with st.chat_message("assistant", avatar="🤖"):  # Assistant avatar
+            response_container = st.empty()
+            record = follow_pending_response(response_container)
+            finish_response(response_container, record, pending["message"])
+
+    # Chat input
+    if prompt := st.chat_input("What would you like to research today?"):
+        # Initialize chat model with provided API key; LangChain is imported here on the first turn
+        chat_model = initialize_chat_model(api_key)
+
+        # Add user message to chat history
+        user_message = {"role": "user", "content": prompt}
+        st.session_state.messages.append(user_message)
+        append_message(user_message, st.session_state.history_file)
+
+        # Display user message
+        with st.chat_message("user", avatar="👤"):  # User avatar
+            st.markdown(prompt)
+
+        # Display assistant response with thinking animation
+        with st.chat_message("assistant", avatar="🤖"):  # Assistant avatar
+            response_container = st.empty()
+
+            # Show thinking/searching status
+            response_container.markdown(
+                _THINKING_TPL.format(prompt=html.escape(prompt[:40]) + ("..." if len(prompt) > 40 else "")),
+                unsafe_allow_html=True
+            )
+
+            # Add the assistant message up front; it is filled in once the response is saved
+            history = st.session_state.messages[:-1]
+            assistant_message = {"role": "assistant", "content": ""}
+            st.session_state.messages.append(assistant_message)
+
+            # Process the chat
+            record = process_chat(prompt, chat_model, response_container, history, assistant_message)
+            finish_response(response_container, record, assistant_message)
+
+# Function to format today's date for the header
+@st.cache_data(ttl=3600, show_spinner=False)
+def _today_str() -> str:
+    """Return today's date for display; refreshed at most hourly."""
+    return datetime.now().strftime("%b %d, %Y")
+
 # Main Streamlit app
 def main():
     apply_custom_css()
@@ -162,7 +788,7 @@ def main():
     with col1:
         st.title(":mag: Perplexity AI Research Assistant")
     with col2:
-        current_time = datetime.now().strftime("%b %d, %Y")
+        current_time = _today_str()
         st.markdown(f"<div style='text-align: right; padding-top: 1rem;'>{current_time}</div>", unsafe_allow_html=True)
 
     st.markdown("Powered by Sonar Deep Research model - Ask any research question to get comprehensive answers with citations.")
@@ -182,63 +808,18 @@ def main():
         """)
         return
 
-    # Initialize chat model with provided API key
-    chat_model = initialize_chat_model(api_key)
-
-    # Initialize chat history in session state
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
-
-    # Display chat history
-    display_chat_history(st.session_state.messages)
-
-    # Chat input
-    if prompt := st.chat_input("What would you like to research today?"):
-        # Add user message to chat history
-        st.session_state.messages.append({"role": "user", "content": prompt})
-
-        # Display user message
-        with st.chat_message("user", avatar="👤"):  # User avatar
-            st.markdown(f"<div class='user-message'>{prompt}</div>", unsafe_allow_html=True)
-
-        # Display assistant response with thinking animation
-        with st.chat_message("assistant", avatar="🤖"):  # Assistant avatar
-            response_container = st.empty()
-
-            # Show thinking/searching status
-            response_container.markdown(
-                f'<div class="thinking-box">'
-                f'<span class="searching-text">Searching</span><br>'
-                f'<span>{prompt[:40]}{"..." if len(prompt) > 40 else ""}</span>'
-                f'</div>',
-                unsafe_allow_html=True
-            )
-
-            # Process the chat
-            response_data = process_chat(prompt, chat_model)
-
-            # Display the response
-            response_container.markdown(
-                f"<div class='assistant-message'>{response_data['content']}</div>",
-                unsafe_allow_html=True
-            )
-
-            # Show metadata about the response
-            st.markdown(
-                f"<div class='meta-info'>Response time: {response_data['time_taken']}s</div>",
-                unsafe_allow_html=True
-            )
-
-            # Add to chat history with metadata
-            st.session_state.messages.append({
-                "role": "assistant",
-                "content": response_data['content'],
-                "metadata": {
-                    "time_taken": response_data['time_taken'],
-                    "timestamp": datetime.now().isoformat(),
-                    "model": MODEL_NAME
-                }
-            })
+    # Initialize chat history in session state; each API key has its own history file
+    history_file = chat_history_file(api_key)
+    if st.session_state.get("history_file") != history_file:
+        # A response still streaming appends to the old key's file by itself; let it
+        # finish there so that history doesn't end on an unanswered user message
+        st.session_state.pop("_pending", None)
+        st.session_state.history_file = history_file
+        st.session_state.messages = load_chat_history(history_file)
+        st.session_state.live_files = []
+
+    # Chat history and input run as a fragment
+    chat_area(api_key)
 
 if __name__ == "__main__":
     main()
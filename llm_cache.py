@@ -0,0 +1,135 @@
+import streamlit as st
+import hashlib
+import json
+import logging
+import shelve
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, List, Optional
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Constants
+CACHE_FILE = "llm_cache.db"
+CACHE_TTL_SECONDS = 7 * 24 * 60 * 60  # 7 days
+SESSION_CACHE_KEY = "llm_cache"
+SESSION_CACHE_MAX_ENTRIES = 128
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+SEMANTIC_THRESHOLD = 0.92
+
+logger = logging.getLogger(__name__)
+
+# Function to get the lock guarding the on-disk cache
+@st.cache_resource(show_spinner=False)
+def get_cache_lock() -> threading.Lock:
+    """Return the process-wide lock held around every shelve access; shelve is not safe for concurrent use."""
+    return threading.Lock()
+
+# Function to build the cache key for a request
+def cache_key(model: str, messages: List, max_tokens: int) -> str:
+    """Return a SHA-256 key over the model, messages and max_tokens.
+
+    Only the new prompt (the last message) is normalized, by trimming and lowercasing it.
+    """
+    *history, prompt = messages
+    payload = json.dumps(
+        {
+            "m": model,
+            "msgs": [(type(message).__name__, message.content) for message in history]
+                    + [(type(prompt).__name__, prompt.content.strip().lower())],
+            "mt": max_tokens,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+# Function to add a response to the session cache
+def _session_put(key: str, content: str):
+    """Store the response in the session cache, evicting the oldest entries past SESSION_CACHE_MAX_ENTRIES."""
+    session_cache = st.session_state.setdefault(SESSION_CACHE_KEY, {})
+    session_cache[key] = content
+    # Evict the oldest entries so long sessions don't grow without bound
+    while len(session_cache) > SESSION_CACHE_MAX_ENTRIES:
+        del session_cache[next(iter(session_cache))]
+
+# Function to look up a cached response
+def check_cache(key: str) -> Optional[str]:
+    """Return the cached response for the key, checking the session before the disk store."""
+    session_cache = st.session_state.setdefault(SESSION_CACHE_KEY, {})
+    if key in session_cache:
+        return session_cache[key]
+
+    try:
+        with get_cache_lock(), shelve.open(CACHE_FILE) as db:
+            entry = db.get(key)
+    except Exception:
+        logger.warning("Failed to read the response cache", exc_info=True)
+        return None
+
+    if entry is None or entry["expires_at"] < time.time():
+        return None
+
+    _session_put(key, entry["content"])
+    return entry["content"]
+
+# Function to store a response in the cache
+def save_to_cache(key: str, content: str):
+    """Store the response in the session cache and the on-disk store."""
+    _session_put(key, content)
+    try:
+        with get_cache_lock(), shelve.open(CACHE_FILE) as db:
+            db[key] = {"content": content, "expires_at": time.time() + CACHE_TTL_SECONDS}
+    except Exception:
+        logger.warning("Failed to write the response cache", exc_info=True)
+
+# Function to load the local embedding model once per process
+@st.cache_resource(show_spinner=False)
+def load_embedding_model():
+    """Load the SentenceTransformer used for the semantic cache."""
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+# Function to get the worker used for background embedding
+@st.cache_resource(show_spinner=False)
+def get_embedding_executor() -> ThreadPoolExecutor:
+    """Return a single-worker executor shared by all sessions."""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed")
+
+# Function to embed a prompt for the semantic cache
+def _embed_prompt(prompt: str) -> "np.ndarray":
+    """Return the L2-normalized embedding of the prompt, loading the model on first use."""
+    return load_embedding_model().encode([prompt], normalize_embeddings=True)[0]
+
+# Function to start embedding a prompt in the background
+def embed_prompt_async(prompt: str) -> Future:
+    """Start embedding the prompt on a worker thread; the future resolves to its vector."""
+    # The model is loaded on the worker too, so the first prompt doesn't wait for the import
+    return get_embedding_executor().submit(_embed_prompt, prompt)
+
+# Function to look up a semantically similar cached response
+def semantic_lookup(vector: "np.ndarray") -> Optional[str]:
+    """Return the cached response whose prompt is most similar to the vector, if above threshold."""
+    vectors = st.session_state.get("sem_vecs")
+    if vectors is None or len(vectors) == 0:
+        return None
+
+    similarities = vectors @ vector
+    idx = int(similarities.argmax())
+    if similarities[idx] >= SEMANTIC_THRESHOLD:
+        return st.session_state.sem_responses[idx]
+    return None
+
+# Function to store a response in the semantic cache
+def semantic_store(vector: "np.ndarray", content: str):
+    """Append the prompt embedding and its response to the semantic cache."""
+    import numpy as np
+
+    vectors = st.session_state.get("sem_vecs")
+    if vectors is None:
+        vectors = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        st.session_state.sem_responses = []
+    st.session_state.sem_vecs = np.vstack([vectors, vector])[-SESSION_CACHE_MAX_ENTRIES:]
+    st.session_state.sem_responses = (st.session_state.sem_responses + [content])[-SESSION_CACHE_MAX_ENTRIES:]